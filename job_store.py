@@ -0,0 +1,158 @@
+import json
+import os
+import threading
+from collections import deque
+
+from cachetools import TTLCache
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+# Job state lives behind a small store interface so the web tier can scale
+# out: the in-memory store keeps today's single-process behaviour, and
+# setting REDIS_URL swaps in a Redis-backed store where any worker process
+# can read any job (log list via RPUSH/LRANGE, metadata in a hash).
+
+JOB_TTL = 3600
+MAX_JOBS = 1000
+MAX_LOG_ENTRIES = 500
+
+
+class InMemoryJobStore:
+    """Bounded in-process store: TTL + LRU eviction, logs capped per job."""
+
+    def __init__(self):
+        self._jobs = TTLCache(maxsize=MAX_JOBS, ttl=JOB_TTL)
+        self._lock = threading.RLock()
+
+    def create(self, job_id):
+        with self._lock:
+            self._jobs[job_id] = {
+                "id": job_id,
+                "status": "running",
+                "logs": deque(maxlen=MAX_LOG_ENTRIES),
+                "log_count": 0,  # total ever appended; keeps ?since cursors
+                                 # absolute even after the deque drops entries
+                "result": None,
+                "progress": 0
+            }
+
+    def update(self, job_id, **fields):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job.update(fields)
+
+    def append_log(self, job_id, entry):
+        """Append one entry; returns its absolute index (1-based), or None
+        if the job is gone."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            job['logs'].append(entry)
+            job['log_count'] += 1
+            return job['log_count']
+
+    def get(self, job_id, since=0):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            payload = {k: v for k, v in job.items() if k not in ('logs', 'log_count')}
+            logs = list(job['logs'])
+            # `since` is absolute; shift it by however many entries the
+            # bounded deque has already dropped.
+            dropped = job['log_count'] - len(logs)
+            start = max(since - dropped, 0)
+            payload['logs'] = logs[start:] if start > 0 else logs
+            payload['total'] = job['log_count']
+            return payload
+
+    def pop(self, job_id):
+        with self._lock:
+            self._jobs.pop(job_id, None)
+
+
+class RedisJobStore:
+    """Shared store for multi-worker deployments.
+
+    Metadata sits in a hash at job:{id}; logs are a Redis list at
+    job:{id}:logs (O(1) append, delta reads via LRANGE). Both keys carry
+    the same TTL the in-memory store uses.
+    """
+
+    def __init__(self, url):
+        self._r = redis.Redis.from_url(url, decode_responses=True)
+
+    def _meta_key(self, job_id):
+        return f"job:{job_id}"
+
+    def _logs_key(self, job_id):
+        return f"job:{job_id}:logs"
+
+    def create(self, job_id):
+        pipe = self._r.pipeline()
+        pipe.hset(self._meta_key(job_id), mapping={
+            "id": job_id, "status": "running", "result": "", "progress": 0
+        })
+        pipe.expire(self._meta_key(job_id), JOB_TTL)
+        pipe.execute()
+
+    def update(self, job_id, **fields):
+        clean = {k: ("" if v is None else v) for k, v in fields.items()}
+        pipe = self._r.pipeline()
+        pipe.hset(self._meta_key(job_id), mapping=clean)
+        pipe.expire(self._meta_key(job_id), JOB_TTL)
+        pipe.execute()
+
+    def append_log(self, job_id, entry):
+        """Append one entry; returns its absolute index (1-based), or None
+        if the job is gone."""
+        if not self._r.exists(self._meta_key(job_id)):
+            return None
+        pipe = self._r.pipeline()
+        pipe.hget(self._meta_key(job_id), "logs_trimmed")
+        pipe.rpush(self._logs_key(job_id), json.dumps(entry))
+        pipe.expire(self._logs_key(job_id), JOB_TTL)
+        trimmed, length, _ = pipe.execute()
+        trimmed = int(trimmed or 0)
+        if length > MAX_LOG_ENTRIES:
+            # Trim the overflow and account for it in logs_trimmed so
+            # absolute ?since cursors stay aligned after eviction (LTRIM
+            # alone would silently shift every index).
+            excess = length - MAX_LOG_ENTRIES
+            pipe = self._r.pipeline()
+            pipe.ltrim(self._logs_key(job_id), excess, -1)
+            pipe.hincrby(self._meta_key(job_id), "logs_trimmed", excess)
+            pipe.execute()
+        return trimmed + length
+
+    def get(self, job_id, since=0):
+        meta = self._r.hgetall(self._meta_key(job_id))
+        if not meta:
+            return None
+        trimmed = int(meta.pop('logs_trimmed', 0) or 0)
+        pipe = self._r.pipeline()
+        pipe.lrange(self._logs_key(job_id), max(since - trimmed, 0), -1)
+        pipe.llen(self._logs_key(job_id))
+        raw, length = pipe.execute()
+        payload = dict(meta)
+        payload['progress'] = int(meta.get('progress') or 0)
+        payload['logs'] = [json.loads(x) for x in raw]
+        payload['total'] = trimmed + length
+        return payload
+
+    def pop(self, job_id):
+        self._r.delete(self._meta_key(job_id), self._logs_key(job_id))
+
+
+def make_job_store():
+    url = os.environ.get("REDIS_URL")
+    if url:
+        if redis is None:
+            raise RuntimeError("REDIS_URL is set but the redis package is not installed")
+        return RedisJobStore(url)
+    return InMemoryJobStore()
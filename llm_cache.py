@@ -0,0 +1,157 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from rate_limiter import estimate_tokens, limiter
+
+# Process-local deterministic cache for temperature=0 LLM calls.
+# QA criteria, research fallback text and record fields recur across jobs and
+# across retry loops within one job, so identical prompts show up constantly.
+# A hit skips the entire OpenAI round-trip (network + tokens).
+
+MAX_ENTRIES = 1024
+
+_cache = OrderedDict()
+_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "bypassed": 0, "disk_hits": 0, "coalesced": 0}
+
+# Single-flight: identical prompts issued concurrently (e.g. duplicate
+# records fanned out in one job, or the same audit from parallel jobs)
+# share one in-flight request instead of racing to N duplicate calls.
+_inflight = {}
+
+# Optional exact-match persistence: set LLM_CACHE_DB to a SQLite path and
+# temperature=0 results survive restarts/deploys. Reads fall through from
+# the in-memory LRU; writes go to both.
+_db = None
+_db_path = os.environ.get("LLM_CACHE_DB")
+if _db_path:
+    _db = sqlite3.connect(_db_path, check_same_thread=False)
+    _db.execute("CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, value TEXT)")
+    _db.commit()
+
+
+def _disk_get(key):
+    if _db is None:
+        return None
+    row = _db.execute("SELECT value FROM llm_cache WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+
+def _disk_put(key, value):
+    if _db is None:
+        return
+    _db.execute("INSERT OR REPLACE INTO llm_cache (key, value) VALUES (?, ?)", (key, value))
+    _db.commit()
+
+
+def _rate_limited_invoke(llm, messages, on_chunk=None):
+    # All outbound LLM traffic funnels through here, so the limiter sees
+    # every request regardless of which worker issued it.
+    limiter.acquire(sum(estimate_tokens(m.content) for m in messages))
+    if on_chunk is None:
+        return llm.invoke(messages).content
+    parts = []
+    for chunk in llm.stream(messages):
+        text = chunk.content
+        if text:
+            parts.append(text)
+            on_chunk(text)
+    return "".join(parts)
+
+
+def _cache_key(model, temperature, messages):
+    payload = json.dumps(
+        {
+            "model": model,
+            "temperature": temperature,
+            "messages": [[m.type, m.content] for m in messages],
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def cached_invoke(llm, messages, on_chunk=None):
+    """Invoke `llm` on a list of messages, returning the text content.
+
+    Results are cached (LRU, bounded) keyed by SHA256 of (model, temperature,
+    messages). Caching only applies at temperature=0, where the call is
+    deterministic; anything else goes straight through.
+
+    Pass `on_chunk` to stream: it receives each content fragment as it is
+    generated (a cache hit delivers the whole text in one call).
+    """
+    temperature = getattr(llm, "temperature", None)
+    if temperature is None or temperature > 0:
+        with _lock:
+            _stats["bypassed"] += 1
+        return _rate_limited_invoke(llm, messages, on_chunk)
+
+    key = _cache_key(getattr(llm, "model_name", "unknown"), temperature, messages)
+
+    while True:
+        with _lock:
+            hit = _lookup_locked(key)
+            if hit is None:
+                ev = _inflight.get(key)
+                if ev is None:
+                    # No result and nobody working on one: we lead.
+                    _inflight[key] = ev = threading.Event()
+                    _stats["misses"] += 1
+                    break
+                _stats["coalesced"] += 1
+        if hit is not None:
+            if on_chunk is not None:
+                on_chunk(hit)
+            return hit
+        # Identical call in flight: wait for its result, then re-check the
+        # cache. If the leader failed, the entry is gone and we lead next.
+        ev.wait(timeout=120)
+
+    try:
+        result = _rate_limited_invoke(llm, messages, on_chunk)
+        with _lock:
+            _cache[key] = result
+            _cache.move_to_end(key)
+            while len(_cache) > MAX_ENTRIES:
+                _cache.popitem(last=False)
+            _disk_put(key, result)
+    finally:
+        with _lock:
+            _inflight.pop(key, None)
+        ev.set()
+
+    return result
+
+
+def _lookup_locked(key):
+    # Caller holds _lock. Memory first, then the optional disk layer.
+    if key in _cache:
+        _stats["hits"] += 1
+        _cache.move_to_end(key)
+        return _cache[key]
+    persisted = _disk_get(key)
+    if persisted is not None:
+        _stats["disk_hits"] += 1
+        _cache[key] = persisted
+        _cache.move_to_end(key)
+        return persisted
+    return None
+
+
+def cache_stats():
+    with _lock:
+        return {"entries": len(_cache), **_stats}
+
+
+def clear():
+    with _lock:
+        _cache.clear()
+        if _db is not None:
+            _db.execute("DELETE FROM llm_cache")
+            _db.commit()
+        _stats.update({"hits": 0, "misses": 0, "bypassed": 0, "disk_hits": 0})
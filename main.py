@@ -1,95 +1,355 @@
+import hashlib
 import os
 import uuid
 import json
+import queue
+import re
+import gzip
+import time
 import threading
+import httpx
+import orjson
 import requests
-from flask import Flask, request, jsonify, render_template_string
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Response, request, jsonify
+from flask.json.provider import JSONProvider
 from datetime import datetime
+from cachetools import TTLCache
 
 # --- IMPORTS ---
 from langchain_openai import ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.output_parsers import JsonOutputParser, StrOutputParser
+from langchain_core.exceptions import OutputParserException
+from langchain_core.output_parsers import JsonOutputParser
+
+from job_store import make_job_store
+from llm_cache import cached_invoke, cache_stats
+from rate_limiter import truncate_tokens
+
+class OrjsonProvider(JSONProvider):
+    # Flask's default provider is pure Python; orjson is several times
+    # faster on the string-heavy status payloads polled by clients.
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 app = Flask(__name__)
-jobs = {}
+app.json = OrjsonProvider(app)
+
+# Gzip JSON responses: log text is highly repetitive and compresses ~5-10x.
+# Only JSON — the index is pre-gzipped at import, and compressing SSE would
+# buffer the stream and defeat incremental delivery.
+try:
+    from flask_compress import Compress
+    app.config['COMPRESS_MIMETYPES'] = ['application/json']
+    app.config['COMPRESS_LEVEL'] = 5
+    Compress(app)
+except ImportError:
+    pass  # optional: uncompressed JSON is correct, just bigger
+
+# Job state: bounded in-memory store by default, Redis when REDIS_URL is
+# set (required for multi-worker deployments — see job_store module).
+# Completed jobs expire after an hour, or immediately once a client acks.
+job_store = make_job_store()
+
+# Bounded worker pool for job execution: threads are reused instead of
+# created per request, and a burst can no longer spawn thousands of them.
+MAX_WORKERS = int(os.environ.get('WORKERS', 32))
+EXECUTOR = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+MAX_QUEUED_JOBS = 100
+
+# Explicit in-flight count (submitted, not yet finished) for load shedding;
+# the executor's own queue depth is an implementation detail.
+_inflight_jobs = 0
+_inflight_lock = threading.Lock()
+
+def _job_finished(_future):
+    global _inflight_jobs
+    with _inflight_lock:
+        _inflight_jobs -= 1
+
+# Separate small pool for speculative work so a saturated job pool can
+# never deadlock waiting on its own speculation.
+SPECULATIVE_EXECUTOR = ThreadPoolExecutor(max_workers=10)
+
+# Per-job event queues for SSE subscribers. Created lazily on the first
+# /api/stream connect so an unwatched job never accumulates a queue.
+# These are in-process: with Redis + multiple workers, live streams only
+# reach subscribers on the worker running the job; /api/status works from
+# any worker.
+log_queues = {}
+queues_lock = threading.Lock()
+_NOTHING = object()  # distinguishes "no queued item" from the None sentinel
+
+# Wake events for /api/wait long-pollers: one Event per blocked request
+# (never shared, so one waiter's wakeup can't be consumed by another),
+# registered only for the lifetime of that request.
+wait_events = {}
+
+def _notify_waiters(job_id):
+    with queues_lock:
+        evs = list(wait_events.get(job_id, ()))
+    for ev in evs:
+        ev.set()
+
+def _push_event(job_id, item):
+    with queues_lock:
+        q = log_queues.get(job_id)
+    if q is not None:
+        q.put(item)
+    _notify_waiters(job_id)
 
 # --- CONFIG ---
-OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY") 
-PERPLEXITY_API_KEY = os.environ.get("PERPLEXITY_API_KEY") 
+OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
+PERPLEXITY_API_KEY = os.environ.get("PERPLEXITY_API_KEY")
+
+# --- SYSTEM PROMPTS ---
+# Hoisted to module level so the static preamble is byte-identical on every
+# call. Provider-side prefix caching only kicks in on an exact prefix match,
+# so per-call data must stay in the user message, never in the system text.
+QA_SYSTEM_PROMPT = (
+    "You are a Manager reviewing work.\n"
+    "\n"
+    "1. Does the content meet the criteria?\n"
+    "2. If NO, explain specifically what to fix.\n"
+    "3. VERY IMPORTANT: Do not reject good data just because of formatting.\n"
+    "\n"
+    'Return JSON: {{ "status": "PASS" | "FAIL", "critique": "Instructions for revision", '
+    '"corrected_output": "Only if you can confidently fix the content yourself, the full corrected version; otherwise omit" }}'
+)
+
+# Writers emit their draft together with a mechanical self-check in one call,
+# so a PASS costs zero extra round-trips (the checks are re-verified in Python).
+WRITER_JSON_INSTRUCTIONS = (
+    'Return JSON: {{ "draft": "the message", '
+    '"self_check": {{ "has_placeholders": bool, "mentions_company": bool, "char_count": int }} }}'
+)
+
+WRITER_SYSTEM_PROMPT = (
+    "You are a Sales Copywriter.\n"
+    "\n"
+    "Write a LinkedIn connection request (max 300 chars).\n"
+    "\n" + WRITER_JSON_INSTRUCTIONS
+)
+
+EDITOR_SYSTEM_PROMPT = (
+    "You are a Copy Editor.\n"
+    "\n"
+    "Rewrite the draft to address the feedback. PRESERVE context.\n"
+    "\n" + WRITER_JSON_INSTRUCTIONS
+)
+
+RESEARCH_REFINE_SYSTEM_PROMPT = (
+    "You are a Senior Research Analyst.\n"
+    "\n"
+    "Task: output a polished research summary. Do NOT delete specific "
+    "facts/numbers found in the draft unless they are wrong."
+)
+
+# --- PROMPT TEMPLATES (parsed once at import, not per call) ---
+QA_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", QA_SYSTEM_PROMPT),
+    ("user", "TASK: {task_name}\nCONTENT: {content}\nCRITERIA: {criteria}"),
+])
+
+RESEARCH_REFINE_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", RESEARCH_REFINE_SYSTEM_PROMPT),
+    ("user", "PREVIOUS DRAFT (Keep the good data from here):\n{previous_draft}\n\nMANAGER'S FEEDBACK (Fix these issues):\n{instructions}"),
+])
+
+EDITOR_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", EDITOR_SYSTEM_PROMPT),
+    ("user", "PREVIOUS DRAFT:\n{previous_draft}\n\nRESEARCH CONTEXT:\n{research}\n\nFEEDBACK TO ADDRESS:\n{instructions}"),
+])
+
+WRITER_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", WRITER_SYSTEM_PROMPT),
+    ("user", "Target: {first_name} at {company}\nResearch: {research}\nInstructions: {instructions}"),
+])
+
+# --- SHARED MODEL CLIENT ---
+# One pooled httpx client for all OpenAI traffic: TCP+TLS handshakes are
+# paid once per connection instead of once per job's first call, and HTTP/2
+# multiplexes the concurrent record fan-out over few sockets.
+_HTTP_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=50)
+_HTTP_CLIENT = httpx.Client(http2=True, limits=_HTTP_LIMITS, timeout=60)
+
+# Built lazily (so importing without OPENAI_API_KEY still works) and then
+# reused by every job; ChatOpenAI is thread-safe.
+_llm = None
+_llm_json = None
+_llm_audit = None
+_llm_lock = threading.Lock()
+
+def get_llm():
+    global _llm
+    with _llm_lock:
+        if _llm is None:
+            _llm = ChatOpenAI(
+                model="gpt-4o",
+                api_key=OPENAI_API_KEY,
+                temperature=0.0,
+                model_kwargs={"prompt_cache_key": "copygen_v1"},
+                http_client=_HTTP_CLIENT,
+            )
+        return _llm
+
+def get_llm_json():
+    # JSON-mode variant for callers that parse the reply: the API refuses
+    # to emit anything but valid JSON, so a malformed audit or writer
+    # response can no longer trigger the auto-pass/raw-text fallbacks.
+    global _llm_json
+    with _llm_lock:
+        if _llm_json is None:
+            _llm_json = ChatOpenAI(
+                model="gpt-4o",
+                api_key=OPENAI_API_KEY,
+                temperature=0.0,
+                model_kwargs={
+                    "prompt_cache_key": "copygen_v1",
+                    "response_format": {"type": "json_object"},
+                },
+                http_client=_HTTP_CLIENT,
+            )
+        return _llm_json
+
+def get_llm_audit():
+    # Grading short content against explicit criteria is a low-stakes
+    # transform; a small model does it at ~10x lower cost and faster TTFT
+    # than the writer's frontier model. Overridable for A/B via env.
+    global _llm_audit
+    with _llm_lock:
+        if _llm_audit is None:
+            _llm_audit = ChatOpenAI(
+                model=os.environ.get("AUDIT_MODEL", "gpt-4o-mini"),
+                api_key=OPENAI_API_KEY,
+                temperature=0.0,
+                model_kwargs={
+                    "prompt_cache_key": "copygen_v1",
+                    "response_format": {"type": "json_object"},
+                },
+                http_client=_HTTP_CLIENT,
+            )
+        return _llm_audit
 
 # --- LOGGING SYSTEM ---
+# Log timestamps only have second resolution, so bursts of entries within
+# the same second can share one strftime result instead of reformatting.
+_ts_cache = (0, "")
+
+def _log_timestamp():
+    global _ts_cache
+    now = int(time.time())
+    sec, text = _ts_cache
+    if now != sec:
+        text = datetime.now().strftime('%H:%M:%S')
+        _ts_cache = (now, text)
+    return text
+
 def log_to_job(job_id, source, message, type="info"):
-    timestamp = datetime.now().strftime('%H:%M:%S')
-    
-    if type == "decision":
-        # Supervisor
-        html = (
-            f"<div class='mt-6 mb-4 p-4 bg-indigo-950/40 border border-indigo-500/50 rounded-lg shadow-lg relative overflow-hidden group hover:border-indigo-400 transition-colors'>"
-            f"<div class='absolute top-0 left-0 w-1 h-full bg-indigo-500'></div>"
-            f"<div class='flex justify-between items-center mb-2'>"
-            f"  <span class='text-indigo-300 font-bold text-xs tracking-widest flex items-center gap-2'>🛡️ SUPERVISOR</span>"
-            f"  <span class='text-indigo-400/50 text-[10px] font-mono'>{timestamp}</span>"
-            f"</div>"
-            f"<div class='text-gray-100 font-mono text-xs font-medium leading-relaxed whitespace-pre-wrap'>{message}</div>"
-            f"</div>"
-        )
-    elif type == "critique":
-        # QA Failed
-        html = (
-            f"<div class='ml-8 mt-2 mb-2 p-3 bg-yellow-900/10 border-l-2 border-yellow-500/50 font-mono text-xs text-yellow-200/80'>"
-            f"<div class='flex items-center gap-2 mb-1 text-yellow-400 font-bold uppercase text-[10px]'>"
-            f"  <span>⚠️ REVISION REQUESTED</span>"
-            f"</div>"
-            f"{message}"
-            f"</div>"
-        )
-    elif type == "thought":
-        # Worker Output
-        html = (
-            f"<div class='ml-8 mt-2 mb-2 p-3 bg-gray-800/40 border-l border-gray-700 font-mono text-xs text-gray-400'>"
-            f"<div class='text-blue-400/70 font-bold mb-1 uppercase text-[10px]'>{source} Output:</div>"
-            f"<div class='whitespace-pre-wrap leading-relaxed'>{message}</div>"
-            f"</div>"
-        )
-    else:
-        # System
-        html = (
-            f"<div class='mt-1 mb-1 text-[10px] text-gray-600 font-mono ml-2 uppercase tracking-wide'>"
-            f"<span class='opacity-50'>[{timestamp}] {source}:</span> {message}"
-            f"</div>"
-        )
-    
-    if job_id in jobs:
-        jobs[job_id]['logs'].append(html)
+    # Logs are stored as small structured records; the browser owns the
+    # HTML templating (see renderLog in the frontend). ~80 bytes per entry
+    # instead of ~500 bytes of prebuilt Tailwind markup.
+    entry = {
+        "t": _log_timestamp(),
+        "s": source,
+        "m": message,
+        "k": type
+    }
+    # The store append stays outside queues_lock: for the Redis backend it
+    # is a network round-trip, and serializing every job's log writes on
+    # one global lock would defeat the fan-out. The returned absolute index
+    # rides along on the event so SSE subscribers that snapshotted the
+    # backlog concurrently can skip an entry they already hold.
+    idx = job_store.append_log(job_id, entry)
+    if idx is not None:
+        _push_event(job_id, ("log", entry, idx))
 
 # --- HELPER: SUPERVISOR AUDIT ---
-def audit_content(llm, job_id, task_name, content, criteria):
+def audit_content(job_id, task_name, content, criteria):
     log_to_job(job_id, "QA_BOT", f"Auditing {task_name} for quality...", type="info")
     
-    prompt = ChatPromptTemplate.from_template(
-        """You are a Manager reviewing work.
-        
-        TASK: {task_name}
-        CONTENT: {content}
-        CRITERIA: {criteria}
-        
-        1. Does it meet criteria?
-        2. If NO, explain specifically what to fix.
-        3. VERY IMPORTANT: Do not reject good data just because of formatting.
-        
-        Return JSON: {{ "status": "PASS" | "FAIL", "critique": "Instructions for revision" }}
-        """
-    )
-    chain = prompt | llm | JsonOutputParser()
+    # JSON keeps structure readable for the auditor; str() on a dict
+    # would interleave Python repr quoting into the prompt.
+    text = content if isinstance(content, str) else orjson.dumps(content, default=str).decode()
     try:
-        res = chain.invoke({"task_name": task_name, "content": str(content)[:3000], "criteria": criteria})
-        return res
-    except:
+        messages = QA_PROMPT.format_messages(task_name=task_name, content=truncate_tokens(text), criteria=criteria)
+        raw = cached_invoke(get_llm_audit(), messages)
+        return JsonOutputParser().parse(raw)
+    except (OutputParserException, json.JSONDecodeError, KeyError) as e:
+        # Only unparseable audit output auto-passes. Timeouts and network
+        # errors propagate to the workflow-level handler instead of being
+        # silently counted as a PASS.
+        log_to_job(job_id, "QA_BOT", f"Audit response unparseable ({type(e).__name__}); auto-passing.", type="info")
         return {"status": "PASS", "critique": ""}
 
+# Compiled once; bounded so a stray '[' late in a long draft can't make the
+# scan quadratic. The token set catches template leftovers the bracket
+# pattern misses (curly-brace style).
+_BRACKET_RE = re.compile(r'\[[^\]\n]{1,40}\]')
+_PLACEHOLDER_TOKENS = frozenset({'[name]', '[company]', '{name}', '{{name}}', '{company}'})
+
+def verify_writer_local(content, company=None):
+    """Mechanical pre-checks on a writer draft. Returns (ok, reason).
+
+    Only covers the criteria a regex can decide (placeholders, length,
+    company mention); the subjective ones stay with the LLM auditor. Pass
+    company=None when the record has no companyName — otherwise a draft
+    can never satisfy a check against a fallback value it was never asked
+    to include.
+    """
+    lowered = content.lower()
+    if _BRACKET_RE.search(content) or any(tok in lowered for tok in _PLACEHOLDER_TOKENS):
+        return (False, "contains placeholder brackets like [Name]")
+    if company and company.lower() not in lowered:
+        return (False, f"does not mention the company ({company})")
+    if len(content) > 300:
+        return (False, f"is {len(content)} characters, over the 300 limit")
+    return (True, "")
+
 # --- WORKERS (Now with 'Refinement' Mode) ---
 
+# One Session for every research call: keep-alive reuses the TCP+TLS
+# connection to api.perplexity.ai instead of paying the handshake per call.
+# Pool sized for the record fan-out (the default of 10 would serialize a
+# full batch), with a short bounded retry on transient upstream errors.
+_PPLX_SESSION = requests.Session()
+_PPLX_SESSION.headers.update({"Authorization": f"Bearer {PERPLEXITY_API_KEY}"})
+_PPLX_SESSION.mount("https://", requests.adapters.HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=64,
+    max_retries=requests.adapters.Retry(
+        total=2, backoff_factor=0.2, status_forcelist=[429, 500, 502, 503, 504],
+    ),
+))
+
+def fetch_live_intel(company, instructions):
+    """Pull live company intel from Perplexity.
+
+    Returns None when no key is configured or the call fails, in which case
+    the caller falls back to the simulated intel used for testing.
+    """
+    if not PERPLEXITY_API_KEY:
+        return None
+    try:
+        resp = _PPLX_SESSION.post(
+            "https://api.perplexity.ai/chat/completions",
+            json={
+                "model": "sonar",
+                "messages": [{
+                    "role": "user",
+                    "content": f"Research the company {company}. {instructions} Answer as a short bullet list of concrete facts.",
+                }],
+            },
+            timeout=(3.05, 30),
+        )
+        resp.raise_for_status()
+        return resp.json()["choices"][0]["message"]["content"]
+    except (requests.RequestException, KeyError, IndexError):
+        return None
+
 def worker_research(llm, job_id, state, instructions, previous_draft=None):
     company = state['company_name']
     
@@ -97,26 +357,18 @@ def worker_research(llm, job_id, state, instructions, previous_draft=None):
         # REFINEMENT MODE: Fix the existing data
         log_to_job(job_id, "RESEARCHER", f"Refining previous research based on feedback: {instructions}", type="info")
         
-        prompt = ChatPromptTemplate.from_template(
-            """You are a Senior Research Analyst.
-            
-            PREVIOUS DRAFT (Keep the good data from here):
-            {previous_draft}
-            
-            MANAGER'S FEEDBACK (Fix these issues):
-            {instructions}
-            
-            Task: output a polished research summary. Do NOT delete specific facts/numbers found in the draft unless they are wrong.
-            """
-        )
-        chain = prompt | llm | StrOutputParser()
-        return chain.invoke({"previous_draft": previous_draft, "instructions": instructions})
+        messages = RESEARCH_REFINE_PROMPT.format_messages(previous_draft=previous_draft, instructions=instructions)
+        return cached_invoke(llm, messages)
 
     else:
         # CREATION MODE: Fresh search
         log_to_job(job_id, "RESEARCHER", f"Starting fresh research: {instructions}", type="info")
         
-        # Simulated "Tool" - In production, this calls Perplexity
+        live = fetch_live_intel(company, instructions)
+        if live is not None:
+            return live
+
+        # Simulated "Tool" fallback when no Perplexity key is configured.
         # We ensure specific data is returned to test the preservation logic
         base_intel = (
             f"Intel on {company}:\n"
@@ -126,60 +378,165 @@ def worker_research(llm, job_id, state, instructions, previous_draft=None):
         )
         return base_intel
 
-def worker_writer(llm, job_id, state, instructions, previous_draft=None):
-    record = state['input_records'][0]
+class _DraftStreamer:
+    """Incrementally pulls the "draft" string value out of the writer's
+    streamed JSON so the UI can show copy as it generates, without waiting
+    for (or exposing) the surrounding JSON envelope."""
+
+    _ESCAPES = {'n': '\n', 't': '\t', 'r': '\r', '"': '"', '\\': '\\', '/': '/'}
+
+    def __init__(self, emit):
+        self._emit = emit
+        self._buf = ""
+        self._in_draft = False
+        self._done = False
+
+    def feed(self, text):
+        if self._done:
+            return
+        self._buf += text
+        if not self._in_draft:
+            m = re.search(r'"draft"\s*:\s*"', self._buf)
+            if m is None:
+                return
+            self._buf = self._buf[m.end():]
+            self._in_draft = True
+        out = []
+        i = 0
+        while i < len(self._buf):
+            c = self._buf[i]
+            if c == '\\':
+                if i + 1 >= len(self._buf):
+                    break  # dangling escape; wait for the next chunk
+                if self._buf[i + 1] == 'u':
+                    step = self._decode_unicode_escape(i, out)
+                    if step == 0:
+                        break  # incomplete \uXXXX; wait for the next chunk
+                    i += step
+                    continue
+                out.append(self._ESCAPES.get(self._buf[i + 1], self._buf[i + 1]))
+                i += 2
+                continue
+            if c == '"':
+                self._done = True
+                break
+            out.append(c)
+            i += 1
+        self._buf = self._buf[i:]
+        if out:
+            self._emit("".join(out))
+
+    def _decode_unicode_escape(self, i, out):
+        """Decode a \\uXXXX escape at self._buf[i], appending to `out`.
+        Returns how many chars were consumed, or 0 if more input is needed
+        (the escape, or a surrogate pair's second half, is still arriving).
+        """
+        if len(self._buf) - i < 6:
+            return 0
+        try:
+            cp = int(self._buf[i + 2:i + 6], 16)
+        except ValueError:
+            out.append(self._buf[i:i + 6])  # malformed; pass through as-is
+            return 6
+        if 0xD800 <= cp <= 0xDBFF:
+            # High surrogate: wait for the partner escape so emoji and
+            # other astral characters come out whole (a lone surrogate
+            # would also crash the orjson SSE encode downstream).
+            follower = self._buf[i + 6:i + 8]
+            if len(follower) == 2 and follower != '\\u':
+                out.append('�')  # definitely unpaired
+                return 6
+            if len(self._buf) - i < 12:
+                return 0
+            if follower == '\\u':
+                try:
+                    lo = int(self._buf[i + 8:i + 12], 16)
+                except ValueError:
+                    lo = -1
+                if 0xDC00 <= lo <= 0xDFFF:
+                    out.append(chr(0x10000 + ((cp - 0xD800) << 10) + (lo - 0xDC00)))
+                    return 12
+            out.append('�')  # unpaired high surrogate
+            return 6
+        if 0xDC00 <= cp <= 0xDFFF:
+            out.append('�')  # unpaired low surrogate
+            return 6
+        out.append(chr(cp))
+        return 6
+
+def _parse_writer_output(raw):
+    # Writers answer in JSON; keep the raw text if the model ignored that.
+    try:
+        res = JsonOutputParser().parse(raw)
+        return res.get("draft", raw) if isinstance(res, dict) else raw
+    except (OutputParserException, json.JSONDecodeError):
+        return raw
+
+def worker_writer(job_id, state, instructions, previous_draft=None, emit_tokens=True):
+    record = state['record']
     first_name = record.get('firstName', 'Partner')
     company = record.get('companyName', 'your company')
     research = state.get('research', 'No data')
-    
+
+    # Speculative callers pass emit_tokens=False: a draft that may be
+    # discarded must not stream into the result pane. The caller flushes
+    # the final text in one frame if the draft is adopted. The token_start
+    # marker tells the pane to clear before the new draft streams in, so a
+    # retry does not append to the rejected draft it replaces.
+    on_chunk = None
+    if emit_tokens:
+        _push_event(job_id, ("token_start", None))
+        streamer = _DraftStreamer(lambda text: _push_event(job_id, ("token", text)))
+        on_chunk = streamer.feed
+
     if previous_draft:
          # REFINEMENT MODE
         log_to_job(job_id, "WRITER", f"Editing draft based on feedback: {instructions}", type="info")
-        prompt = ChatPromptTemplate.from_template(
-            """You are a Copy Editor.
-            
-            PREVIOUS DRAFT:
-            {previous_draft}
-            
-            RESEARCH CONTEXT:
-            {research}
-            
-            FEEDBACK TO ADDRESS:
-            {instructions}
-            
-            Rewrite the draft to address the feedback. PRESERVE context.
-            """
-        )
-        chain = prompt | llm | StrOutputParser()
-        return chain.invoke({"previous_draft": previous_draft, "research": research, "instructions": instructions})
-        
+        messages = EDITOR_PROMPT.format_messages(previous_draft=previous_draft, research=research, instructions=instructions)
+        return _parse_writer_output(cached_invoke(get_llm_json(), messages, on_chunk=on_chunk))
+
     else:
         # CREATION MODE
         log_to_job(job_id, "WRITER", "Drafting initial message...", type="info")
-        prompt = ChatPromptTemplate.from_template(
-            """You are a Sales Copywriter.
-            
-            Target: {first_name} at {company}
-            Research: {research}
-            Instructions: {instructions}
-            
-            Write a LinkedIn connection request (max 300 chars).
-            """
-        )
-        chain = prompt | llm | StrOutputParser()
-        return chain.invoke({"first_name": first_name, "company": company, "research": research, "instructions": instructions})
+        messages = WRITER_PROMPT.format_messages(first_name=first_name, company=company, research=research, instructions=instructions)
+        return _parse_writer_output(cached_invoke(get_llm_json(), messages, on_chunk=on_chunk))
 
 # --- WORKFLOW ---
-def process_workflow(job_id, input_data):
-    job = jobs[job_id]
-    llm = ChatOpenAI(model="gpt-4o", api_key=OPENAI_API_KEY, temperature=0.0)
+MAX_RETRIES = 3
+MAX_PARALLEL_RECORDS = 10  # concurrency cap so a big batch respects RPM limits
 
-    records = input_data['input_json'].get('records', [])
-    if not records: return
-    
+# Phase-output cache: research keyed by the exact inputs that produced it,
+# so bulk re-runs over the same records (e.g. regenerating copy with a
+# tweaked writer criterion) reuse the research phase for free.
+PHASE_CACHE = TTLCache(maxsize=512, ttl=3600)
+phase_cache_lock = threading.Lock()
+
+def _phase_cache_key(role, record, instructions):
+    # Key on the fields the phase actually consumes, not the whole record:
+    # CRM exports carry volatile noise (ids, timestamps) that would make
+    # otherwise-identical research inputs miss the cache.
+    payload = orjson.dumps(
+        {
+            "phase": role,
+            "company": record.get('companyName'),
+            "instructions": instructions,
+        },
+        option=orjson.OPT_SORT_KEYS,
+    )
+    return hashlib.sha256(payload).hexdigest()
+
+def process_record(llm, job_id, record, on_phase_done, emit_tokens=True):
+    """Run the full RESEARCH -> WRITE pipeline for a single record.
+
+    Records are independent of each other, so callers may run several of
+    these concurrently — but then pass emit_tokens=False: concurrent
+    writers would interleave their tokens into one garbled stream, so live
+    token streaming is reserved for single-record jobs. `on_phase_done` is
+    called once per completed phase for progress reporting.
+    """
     state = {
-        "input_records": records,
-        "company_name": records[0].get('companyName', "Unknown"),
+        "record": record,
+        "company_name": record.get('companyName', "Unknown"),
         "research": None,
         "copy": None,
         "last_drafts": {"RESEARCHER": None, "WRITER": None}, # STORAGE FOR FAILED DRAFTS
@@ -189,88 +546,357 @@ def process_workflow(job_id, input_data):
         },
         "retry_counts": {"RESEARCHER": 0, "WRITER": 0}
     }
-    
+
     # Define phases
     phases = [
         {"role": "RESEARCHER", "key": "research", "criteria": "Must include specific facts (acquisitions, stock, or tech)."},
         {"role": "WRITER", "key": "copy", "criteria": "Must NOT use [Name]. Must reference the research findings. Casual tone."}
     ]
-    
+
     current_phase_idx = 0
-    MAX_RETRIES = 3
 
-    try:
-        while current_phase_idx < len(phases):
-            phase = phases[current_phase_idx]
-            role = phase['role']
-            key = phase['key']
-            
-            # 1. EXECUTE (Check if we are starting fresh or refining)
-            if state[key] is None:
-                current_instruction = state['instructions'][role]
-                previous_draft = state['last_drafts'][role] # Retrieve bad draft if exists
-                
-                if role == "RESEARCHER":
+    # These sub-dicts are stable for the life of the record; bind them once
+    # instead of re-walking `state` on every loop iteration.
+    instructions = state['instructions']
+    last_drafts = state['last_drafts']
+    retry_counts = state['retry_counts']
+
+    while current_phase_idx < len(phases):
+        phase = phases[current_phase_idx]
+        role = phase['role']
+        key = phase['key']
+
+        # 1. EXECUTE (Check if we are starting fresh or refining)
+        if state[key] is None:
+            current_instruction = instructions[role]
+            previous_draft = last_drafts[role] # Retrieve bad draft if exists
+
+            if role == "RESEARCHER":
+                if previous_draft is None:
+                    # Fresh research for identical inputs is reusable across jobs
+                    cache_key = _phase_cache_key(role, record, current_instruction)
+                    with phase_cache_lock:
+                        out = PHASE_CACHE.get(cache_key)
+                    if out is None:
+                        out = worker_research(llm, job_id, state, current_instruction, None)
+                        with phase_cache_lock:
+                            PHASE_CACHE[cache_key] = out
+                    else:
+                        log_to_job(job_id, "RESEARCHER", "Reusing cached research for identical inputs.", type="info")
+                else:
                     out = worker_research(llm, job_id, state, current_instruction, previous_draft)
-                elif role == "WRITER":
-                    out = worker_writer(llm, job_id, state, current_instruction, previous_draft)
-                
-                state[key] = out
-            
+            elif role == "WRITER":
+                out = worker_writer(job_id, state, current_instruction, previous_draft, emit_tokens=emit_tokens)
+
+            state[key] = out
+
+        else:
+            # 2. AUDIT
+            # The mechanical WRITER criteria (placeholders, length) are
+            # checked in Python first: a local failure is certain and free,
+            # so it skips the LLM call entirely. Drafts that survive still
+            # face the auditor for the subjective criteria (references the
+            # research, casual tone).
+            if role == "WRITER":
+                ok, reason = verify_writer_local(state[key], record.get('companyName'))
+                if ok:
+                    audit = audit_content(job_id, role, state[key], phase['criteria'])
+                else:
+                    audit = {
+                        "status": "FAIL",
+                        "critique": f"The draft {reason}. Fix this and keep the rest."
+                    }
+            else:
+                # The writer only needs the research text and research audits
+                # usually pass, so draft speculatively while the audit runs;
+                # keep the draft only on PASS, discard it on FAIL.
+                spec = None
+                if state['copy'] is None:
+                    # Snapshot the state at submit time: cancel() can't stop
+                    # a future that already started, and an abandoned spec
+                    # must not see later mutations (e.g. research wiped to
+                    # None by the retry path). Tokens are not streamed — a
+                    # draft that may be discarded must never reach the UI.
+                    spec_state = dict(state)
+                    spec = SPECULATIVE_EXECUTOR.submit(
+                        worker_writer, job_id, spec_state,
+                        instructions['WRITER'], last_drafts['WRITER'],
+                        emit_tokens=False
+                    )
+                audit = audit_content(job_id, role, state[key], phase['criteria'])
+                if spec is not None:
+                    if audit['status'] == "PASS":
+                        draft = spec.result()
+                        state['copy'] = draft
+                        if draft and emit_tokens:
+                            # Flush the deferred stream in one frame, same
+                            # shape a cache hit produces.
+                            _push_event(job_id, ("token_start", None))
+                            _push_event(job_id, ("token", draft))
+                    else:
+                        # Best effort: if it already started it finishes
+                        # quietly and the result is dropped.
+                        spec.cancel()
+
+            if audit['status'] == "PASS":
+                log_to_job(job_id, "QA", "Approved.", type="success")
+                current_phase_idx += 1
+                on_phase_done()
             else:
-                # 2. AUDIT
-                audit = audit_content(llm, job_id, role, state[key], phase['criteria'])
-                
-                if audit['status'] == "PASS":
-                    log_to_job(job_id, "QA", "Approved.", type="success")
+                # RETRY LOGIC (NON-DESTRUCTIVE)
+                critique = (audit.get('critique') or '').strip()
+                if not critique or critique == instructions[role]:
+                    # At temperature=0 the same instructions reproduce the
+                    # same draft; retrying would burn every remaining retry
+                    # for an identical FAIL. Accept the best we have.
+                    log_to_job(job_id, "QA", "No actionable critique; accepting current output.", type="info")
                     current_phase_idx += 1
-                else:
-                    # RETRY LOGIC (NON-DESTRUCTIVE)
-                    retries = state['retry_counts'][role]
-                    if retries < MAX_RETRIES:
-                        state['retry_counts'][role] += 1
-                        
-                        # Save the "bad" result as a draft for the next loop
-                        state['last_drafts'][role] = state[key] 
-                        
+                    on_phase_done()
+                    continue
+                if retry_counts[role] < MAX_RETRIES:
+                    retry_counts[role] += 1
+
+                    # Save the "bad" result as a draft for the next loop
+                    last_drafts[role] = state[key]
+
+                    log_to_job(job_id, "QA", f"Critique: {audit['critique']}", type="critique")
+
+                    corrected = (audit.get('corrected_output') or '').strip()
+                    if corrected:
+                        # The auditor fixed it inline: adopt the correction
+                        # and go straight back to audit, skipping a full
+                        # worker round-trip.
+                        state[key] = corrected
+                        log_to_job(job_id, "SUPERVISOR", "Supervisor supplied a corrected version; re-auditing...", type="decision")
+                    else:
                         # Update instructions for the revision
-                        state['instructions'][role] = audit['critique']
-                        
+                        instructions[role] = audit['critique']
+
                         # Wipe the "final" key to trigger the execution block again
-                        state[key] = None 
-                        
-                        log_to_job(job_id, "QA", f"Critique: {audit['critique']}", type="critique")
+                        state[key] = None
+
                         log_to_job(job_id, "SUPERVISOR", f"Returning draft to {role} for revision...", type="decision")
-                    else:
-                        log_to_job(job_id, "QA", "Max retries hit. Proceeding with best available.", type="info")
-                        current_phase_idx += 1
+                else:
+                    log_to_job(job_id, "QA", "Max retries hit. Proceeding with best available.", type="info")
+                    current_phase_idx += 1
+                    on_phase_done()
+
+    return state['copy']
+
+def process_workflow(job_id, input_data):
+    llm = get_llm()
 
-            job['progress'] = int(((current_phase_idx) / len(phases)) * 100)
+    records = input_data['input_json'].get('records', [])
+    if not records: return
+
+    total_phases = len(records) * 2
+    progress_lock = threading.Lock()
+    done_phases = [0]
 
-        job['result'] = state['copy']
-        job['status'] = "completed"
-        job['progress'] = 100
+    def on_phase_done():
+        with progress_lock:
+            done_phases[0] += 1
+            pct = int((done_phases[0] / total_phases) * 100)
+        job_store.update(job_id, progress=pct)
+        _push_event(job_id, ("progress", pct))
+
+    try:
+        if len(records) == 1:
+            copies = [process_record(llm, job_id, records[0], on_phase_done)]
+        else:
+            # Records are independent: fan them out so K records cost
+            # ~one pipeline latency instead of K of them.
+            workers = min(len(records), MAX_PARALLEL_RECORDS)
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                copies = list(pool.map(
+                    lambda r: process_record(llm, job_id, r, on_phase_done,
+                                             emit_tokens=False),
+                    records
+                ))
+
+        job_store.update(
+            job_id,
+            result="\n\n---\n\n".join(c for c in copies if c),
+            status="completed",
+            progress=100
+        )
         log_to_job(job_id, "SYSTEM", "Workflow Complete.")
 
     except Exception as e:
-        job['status'] = "failed"
+        job_store.update(job_id, status="failed")
         log_to_job(job_id, "SYSTEM", f"Critical Error: {e}")
 
+    _push_event(job_id, None)  # wake SSE subscribers for the terminal event
+
 # --- API ROUTES ---
 @app.route('/')
-def index(): return render_template_string(HTML_TEMPLATE)
+def index():
+    # The template has zero dynamic parts, so skip Jinja entirely, serve
+    # bytes compressed once at import, and let browsers revalidate with an
+    # ETag instead of re-downloading.
+    if 'gzip' in request.headers.get('Accept-Encoding', ''):
+        resp = Response(INDEX_GZIP, mimetype='text/html')
+        resp.headers['Content-Encoding'] = 'gzip'
+        resp.set_etag(INDEX_ETAG + '-gz')
+    else:
+        resp = Response(INDEX_BYTES, mimetype='text/html')
+        resp.set_etag(INDEX_ETAG)
+    resp.headers['Vary'] = 'Accept-Encoding'
+    resp.headers['Cache-Control'] = 'public, max-age=3600'
+    return resp.make_conditional(request)
 
 @app.route('/api/start', methods=['POST'])
 def start_job():
+    global _inflight_jobs
     data = request.json
+    # Shed load once the backlog beyond the running workers exceeds the cap.
+    with _inflight_lock:
+        if _inflight_jobs >= MAX_WORKERS + MAX_QUEUED_JOBS:
+            return jsonify({"error": "too many queued jobs, try again later"}), 429
+        _inflight_jobs += 1
     job_id = str(uuid.uuid4())
-    jobs[job_id] = {"id": job_id, "status": "running", "logs": [], "result": None, "progress": 0}
-    threading.Thread(target=process_workflow, args=(job_id, data)).start()
+    job_store.create(job_id)
+    EXECUTOR.submit(process_workflow, job_id, data).add_done_callback(_job_finished)
     return jsonify({"job_id": job_id})
 
 @app.route('/api/status/<job_id>')
 def status(job_id):
-    return jsonify(jobs.get(job_id, {"error": "not found"}))
+    # Pollers pass ?since=<count already seen> to fetch only the tail
+    since = request.args.get('since', default=0, type=int)
+    payload = job_store.get(job_id, since=since)
+    if payload is None:
+        return jsonify({"error": "not found"})
+    # Once a client has seen the terminal state it can ack to free the slot
+    if payload['status'] in ('completed', 'failed') and request.args.get('ack'):
+        job_store.pop(job_id)
+    return jsonify(payload)
+
+@app.route('/api/wait/<job_id>')
+def wait_status(job_id):
+    """Long-poll flavour of /api/status: blocks until new logs or a
+    terminal state (25s max), so quiet phases cost one request instead
+    of dozens of empty polls."""
+    since = request.args.get('since', default=0, type=int)
+    # Register the wake event *before* reading the store: a log appended
+    # after the read then sets our event instead of being lost, and the
+    # re-check below returns immediately if data already exists.
+    ev = threading.Event()
+    with queues_lock:
+        wait_events.setdefault(job_id, []).append(ev)
+    try:
+        payload = job_store.get(job_id, since=since)
+        if payload is None:
+            return jsonify({"error": "not found"})
+        if payload['logs'] or payload['status'] != 'running':
+            return jsonify(payload)
+        ev.wait(timeout=25)
+        return jsonify(job_store.get(job_id, since=since) or {"error": "not found"})
+    finally:
+        # Each request cleans up its own event, so expired jobs can't
+        # leak registrations.
+        with queues_lock:
+            evs = wait_events.get(job_id)
+            if evs is not None:
+                try:
+                    evs.remove(ev)
+                except ValueError:
+                    pass
+                if not evs:
+                    wait_events.pop(job_id, None)
+
+@app.route('/api/stream/<job_id>')
+def stream(job_id):
+    """Server-Sent Events: push log fragments as they happen instead of
+    having the client re-download the whole log list every 800ms."""
+    def generate():
+        # No yields inside the lock: the generator suspends at each yield
+        # until the client consumes it, and a stalled client must never
+        # sit on the global queues_lock.
+        with queues_lock:
+            job = job_store.get(job_id)
+            if job is not None:
+                # Queue first, then snapshot: every log event lands in the
+                # snapshot or the queue (an append racing this connect may
+                # land in both; entries at or below the snapshot boundary
+                # are skipped below).
+                q = log_queues.setdefault(job_id, queue.Queue())
+                backlog = job['logs']
+                snap_end = job['total']  # absolute index of the snapshot's last entry
+                running = job['status'] == 'running'
+        if job is None:
+            yield "event: done\ndata: {\"error\": \"not found\"}\n\n"
+            return
+
+        # The finally is what drops the queue when the client disconnects:
+        # the server raises GeneratorExit at the current yield, and without
+        # it _push_event would keep filling an orphaned queue for the rest
+        # of the job (and the process would hold it forever).
+        try:
+            for entry in backlog:
+                yield b"data: " + orjson.dumps(entry) + b"\n\n"
+
+            while running:
+                try:
+                    item = q.get(timeout=30)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                if item is None:
+                    break
+                kind, payload = item[0], item[1]
+                if kind == "token":
+                    # Coalesce token bursts into one frame (up to 8 tokens or
+                    # 50ms): ~8x fewer socket writes with no visible lag.
+                    buf = [payload]
+                    held = _NOTHING
+                    deadline = time.monotonic() + 0.05
+                    while len(buf) < 8 and time.monotonic() < deadline:
+                        try:
+                            nxt = q.get_nowait()
+                        except queue.Empty:
+                            time.sleep(0.005)
+                            continue
+                        if nxt is not None and nxt[0] == "token":
+                            buf.append(nxt[1])
+                        else:
+                            held = nxt  # non-token item (or the None sentinel)
+                            break
+                    yield b"event: token\ndata: " + orjson.dumps("".join(buf)) + b"\n\n"
+                    if held is _NOTHING:
+                        continue
+                    if held is None:
+                        break
+                    item = held
+                    kind, payload = item[0], item[1]
+                if kind == "log":
+                    # Compare against the fixed snapshot boundary only:
+                    # indices are assigned under the store lock but queued
+                    # outside it, so N+1 can be enqueued before N and a
+                    # moving high-water mark would wrongly drop N.
+                    if item[2] > snap_end:
+                        yield b"data: " + orjson.dumps(payload) + b"\n\n"
+                elif kind == "progress":
+                    yield f"event: progress\ndata: {payload}\n\n".encode()
+                elif kind == "token_start":
+                    yield b"event: token_start\ndata: \"\"\n\n"
+
+            job = job_store.get(job_id) or {}
+            final = {
+                "status": job.get('status'),
+                "result": job.get('result'),
+                "progress": job.get('progress')
+            }
+            yield b"event: done\ndata: " + orjson.dumps(final) + b"\n\n"
+        finally:
+            with queues_lock:
+                log_queues.pop(job_id, None)
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.route('/api/cache_stats')
+def api_cache_stats():
+    return jsonify(cache_stats())
 
 # --- FRONTEND TEMPLATE ---
 HTML_TEMPLATE = """
@@ -352,8 +978,47 @@ HTML_TEMPLATE = """
     </div>
 
     <script>
-        let jobId = null, timer = null;
+        let jobId = null, es = null;
         const logsContainer = document.getElementById('logs');
+        function esc(s) {
+            // LLM critiques and record fields flow into the log; never let
+            // a stray '<' (or injected markup) hit insertAdjacentHTML raw.
+            return String(s ?? '').replace(/&/g, '&amp;').replace(/</g, '&lt;')
+                .replace(/>/g, '&gt;').replace(/"/g, '&quot;').replace(/'/g, '&#39;');
+        }
+        function renderLog(l) {
+            if (l.k === 'decision') {
+                // Supervisor
+                return `<div class='mt-6 mb-4 p-4 bg-indigo-950/40 border border-indigo-500/50 rounded-lg shadow-lg relative overflow-hidden group hover:border-indigo-400 transition-colors'>` +
+                    `<div class='absolute top-0 left-0 w-1 h-full bg-indigo-500'></div>` +
+                    `<div class='flex justify-between items-center mb-2'>` +
+                    `  <span class='text-indigo-300 font-bold text-xs tracking-widest flex items-center gap-2'>🛡️ SUPERVISOR</span>` +
+                    `  <span class='text-indigo-400/50 text-[10px] font-mono'>${esc(l.t)}</span>` +
+                    `</div>` +
+                    `<div class='text-gray-100 font-mono text-xs font-medium leading-relaxed whitespace-pre-wrap'>${esc(l.m)}</div>` +
+                    `</div>`;
+            }
+            if (l.k === 'critique') {
+                // QA Failed
+                return `<div class='ml-8 mt-2 mb-2 p-3 bg-yellow-900/10 border-l-2 border-yellow-500/50 font-mono text-xs text-yellow-200/80'>` +
+                    `<div class='flex items-center gap-2 mb-1 text-yellow-400 font-bold uppercase text-[10px]'>` +
+                    `  <span>⚠️ REVISION REQUESTED</span>` +
+                    `</div>` +
+                    `${esc(l.m)}` +
+                    `</div>`;
+            }
+            if (l.k === 'thought') {
+                // Worker Output
+                return `<div class='ml-8 mt-2 mb-2 p-3 bg-gray-800/40 border-l border-gray-700 font-mono text-xs text-gray-400'>` +
+                    `<div class='text-blue-400/70 font-bold mb-1 uppercase text-[10px]'>${esc(l.s)} Output:</div>` +
+                    `<div class='whitespace-pre-wrap leading-relaxed'>${esc(l.m)}</div>` +
+                    `</div>`;
+            }
+            // System
+            return `<div class='mt-1 mb-1 text-[10px] text-gray-600 font-mono ml-2 uppercase tracking-wide'>` +
+                `<span class='opacity-50'>[${esc(l.t)}] ${esc(l.s)}:</span> ${esc(l.m)}` +
+                `</div>`;
+        }
         async function startJob() {
             const input = document.getElementById('jsonInput').value;
             try { JSON.parse(input); } catch { return alert("Invalid JSON"); }
@@ -365,20 +1030,35 @@ HTML_TEMPLATE = """
             document.getElementById('statusBadge').innerText = "ACTIVE";
             document.getElementById('statusBadge').className = "bg-indigo-900/30 px-3 py-1.5 rounded text-[10px] font-mono uppercase tracking-widest text-indigo-400 border border-indigo-500/50 blink";
             document.getElementById('thinking').classList.remove('hidden');
-            timer = setInterval(poll, 800);
+            subscribe();
         }
-        async function poll() {
-            if (!jobId) return;
-            const res = await fetch(`/api/status/${jobId}`);
-            const data = await res.json();
-            if (logsContainer.children.length !== data.logs.length) {
-                logsContainer.innerHTML = data.logs.join('');
+        function subscribe() {
+            if (es) es.close();
+            es = new EventSource(`/api/stream/${jobId}`);
+            es.onmessage = (e) => {
+                logsContainer.insertAdjacentHTML('beforeend', renderLog(JSON.parse(e.data)));
                 requestAnimationFrame(() => logsContainer.scrollTop = logsContainer.scrollHeight);
-            }
-            document.getElementById('pct').innerText = data.progress + "%";
-            if (data.status !== 'running') {
-                clearInterval(timer);
-                document.getElementById('statusBadge').innerText = data.status.toUpperCase();
+            };
+            es.addEventListener('progress', (e) => {
+                document.getElementById('pct').innerText = e.data + "%";
+            });
+            let streamed = '';
+            es.addEventListener('token_start', () => {
+                // New draft incoming: clear whatever the previous attempt
+                // streamed so a retry replaces it instead of appending.
+                streamed = '';
+                document.getElementById('result').innerText = '';
+            });
+            es.addEventListener('token', (e) => {
+                if (!streamed) document.getElementById('result').innerText = '';
+                streamed += JSON.parse(e.data);
+                document.getElementById('result').innerText = streamed;
+            });
+            es.addEventListener('done', (e) => {
+                es.close();
+                const data = JSON.parse(e.data);
+                document.getElementById('pct').innerText = (data.progress ?? 0) + "%";
+                document.getElementById('statusBadge').innerText = (data.status || 'error').toUpperCase();
                 if (data.status === 'completed') {
                      document.getElementById('statusBadge').className = "bg-emerald-900/30 px-3 py-1.5 rounded text-[10px] font-mono uppercase tracking-widest text-emerald-400 border border-emerald-500/50";
                      document.getElementById('result').innerText = data.result;
@@ -386,13 +1066,19 @@ HTML_TEMPLATE = """
                      document.getElementById('statusBadge').className = "bg-red-900/30 px-3 py-1.5 rounded text-[10px] font-mono uppercase tracking-widest text-red-400 border border-red-500/50";
                 }
                 document.getElementById('thinking').classList.add('hidden');
-            }
+                fetch(`/api/status/${jobId}?ack=1`); // let the server drop the job
+            });
         }
     </script>
 </body>
 </html>
 """
 
+INDEX_BYTES = HTML_TEMPLATE.encode("utf-8")
+INDEX_GZIP = gzip.compress(INDEX_BYTES, 9)
+INDEX_ETAG = hashlib.sha256(INDEX_BYTES).hexdigest()[:16]
+
 if __name__ == '__main__':
+    # Dev convenience only — production runs under gunicorn (see Procfile).
     port = int(os.environ.get('PORT', 5000))
-    app.run(host='0.0.0.0', port=port)
+    app.run(host='0.0.0.0', port=port, threaded=True)
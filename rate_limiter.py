@@ -0,0 +1,75 @@
+import os
+import threading
+import time
+
+# Proactive client-side rate limiting for OpenAI calls. Waiting a fraction of
+# a second up front beats tripping a 429 and eating the library's exponential
+# backoff, which can stall a burst for tens of seconds.
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("o200k_base")
+
+    def estimate_tokens(text):
+        return len(_encoding.encode(text))
+
+    def truncate_tokens(text, head=300, tail=100):
+        """Cap text to ~head+tail tokens, keeping the start and the end
+        (where facts and conclusions tend to live)."""
+        toks = _encoding.encode(text)
+        if len(toks) <= head + tail:
+            return text
+        return _encoding.decode(toks[:head]) + "\n...\n" + _encoding.decode(toks[-tail:])
+except ImportError:
+    def estimate_tokens(text):
+        # ~4 chars per token is close enough for budgeting purposes
+        return max(1, len(text) // 4)
+
+    def truncate_tokens(text, head=300, tail=100):
+        if len(text) <= (head + tail) * 4:
+            return text
+        return text[:head * 4] + "\n...\n" + text[-tail * 4:]
+
+
+class RateLimiter:
+    """Dual token bucket tracking requests/minute and tokens/minute.
+
+    Both buckets refill continuously; acquire() blocks until there is room
+    for one request and the estimated token load.
+    """
+
+    def __init__(self, rpm=500, tpm=90_000):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = float(rpm)
+        self._tokens = float(tpm)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, estimated_tokens=1):
+        estimated_tokens = min(estimated_tokens, self.tpm)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                elapsed = now - self._last
+                self._last = now
+                self._requests = min(float(self.rpm), self._requests + elapsed * self.rpm / 60.0)
+                self._tokens = min(float(self.tpm), self._tokens + elapsed * self.tpm / 60.0)
+
+                if self._requests >= 1.0 and self._tokens >= estimated_tokens:
+                    self._requests -= 1.0
+                    self._tokens -= estimated_tokens
+                    return
+
+                wait = max(
+                    (1.0 - self._requests) / (self.rpm / 60.0),
+                    (estimated_tokens - self._tokens) / (self.tpm / 60.0),
+                )
+            time.sleep(min(wait, 1.0))
+
+
+# Shared limiter for the whole process; tune via env to match account limits.
+limiter = RateLimiter(
+    rpm=int(os.environ.get("OPENAI_RPM", 500)),
+    tpm=int(os.environ.get("OPENAI_TPM", 90_000)),
+)